@@ -1,9 +1,13 @@
 # app.py — Gooclaim Coding Agent → FHIR Bundle (MVP with CPT + HCPCS + performed-procedure rules)
 # Run:  streamlit run app.py
-# Reqs: pip install streamlit
-
-import os, json, uuid, re
-from datetime import datetime
+# Reqs: pip install streamlit pyahocorasick orjson
+
+import os, re, random
+from bisect import bisect_left, bisect_right
+from time import gmtime, strftime
+from types import MappingProxyType
+import ahocorasick
+import orjson
 import streamlit as st
 
 st.set_page_config(page_title="Gooclaim Coding → FHIR", page_icon="🧾", layout="centered")
@@ -13,90 +17,156 @@ st.caption("Intake → ICD‑10‑CM + CPT/HCPCS with evidence-aware 'performed'
 # ---------------------------
 # Dictionaries (very small demo lexicon)
 # ---------------------------
-CPT_MAP = {
-    # Imaging
-    "chest x-ray single view": {"code":"71045", "display":"Radiologic examination, chest; single view", "system":"http://www.ama-assn.org/go/cpt"},
-    "chest x-ray two views":  {"code":"71046", "display":"Radiologic examination, chest; 2 views",       "system":"http://www.ama-assn.org/go/cpt"},
-
-    # Office/EM defaults (we populate separately but leave here for reference)
-    "em_99213": {"code":"99213","display":"Office/outpatient visit, established patient, low MDM","system":"http://www.ama-assn.org/go/cpt"},
-
-    # Respiratory therapy
-    "nebulizer treatment": {"code":"94640","display":"Pressurized or nonpressurized inhalation treatment for acute airway obstruction","system":"http://www.ama-assn.org/go/cpt"},
-
-    # Injections (generic placeholder; in real systems you'd pick precise admin codes)
-    "therapeutic injection": {"code":"96372","display":"Therapeutic, prophylactic, or diagnostic injection; subcutaneous or intramuscular","system":"http://www.ama-assn.org/go/cpt"},
-}
-
-HCPCS_MAP = {
-    # Common drug/supply examples (illustrative only)
-    "albuterol neb": {"code":"J7613","display":"Albuterol, inhalation solution, FDA-approved final product, non-compounded, 1 mg","system":"https://www.cms.gov/mcd/hcpcs"},
-    "ceftriaxone inj": {"code":"J0696","display":"Injection, ceftriaxone sodium, per 250 mg","system":"https://www.cms.gov/mcd/hcpcs"},
-    "dexamethasone inj": {"code":"J1100","display":"Injection, dexamethasone sodium phosphate, 1 mg","system":"https://www.cms.gov/mcd/hcpcs"},
-    # Vaccines & admins often have G-codes or specific CPTs; this is just a demo subset
-}
-
-PERFORMED_HINTS = [
+# Entries are read-only; rules hand out the constants directly and tiny_rules
+# copies them into its results.
+# Imaging
+CPT_CXR_1V = MappingProxyType({"code":"71045", "display":"Radiologic examination, chest; single view", "system":"http://www.ama-assn.org/go/cpt"})
+CPT_CXR_2V = MappingProxyType({"code":"71046", "display":"Radiologic examination, chest; 2 views",       "system":"http://www.ama-assn.org/go/cpt"})
+
+# Office/EM defaults (we populate separately but leave here for reference)
+CPT_EM_99213 = MappingProxyType({"code":"99213","display":"Office/outpatient visit, established patient, low MDM","system":"http://www.ama-assn.org/go/cpt"})
+
+# Respiratory therapy
+CPT_NEB = MappingProxyType({"code":"94640","display":"Pressurized or nonpressurized inhalation treatment for acute airway obstruction","system":"http://www.ama-assn.org/go/cpt"})
+
+# Injections (generic placeholder; in real systems you'd pick precise admin codes)
+CPT_INJ = MappingProxyType({"code":"96372","display":"Therapeutic, prophylactic, or diagnostic injection; subcutaneous or intramuscular","system":"http://www.ama-assn.org/go/cpt"})
+
+CPT_MAP = MappingProxyType({
+    "chest x-ray single view": CPT_CXR_1V,
+    "chest x-ray two views":   CPT_CXR_2V,
+    "em_99213":                CPT_EM_99213,
+    "nebulizer treatment":     CPT_NEB,
+    "therapeutic injection":   CPT_INJ,
+})
+
+# Common drug/supply examples (illustrative only)
+HCPCS_ALBUTEROL_NEB = MappingProxyType({"code":"J7613","display":"Albuterol, inhalation solution, FDA-approved final product, non-compounded, 1 mg","system":"https://www.cms.gov/mcd/hcpcs"})
+HCPCS_CEFTRIAXONE_INJ = MappingProxyType({"code":"J0696","display":"Injection, ceftriaxone sodium, per 250 mg","system":"https://www.cms.gov/mcd/hcpcs"})
+HCPCS_DEXAMETHASONE_INJ = MappingProxyType({"code":"J1100","display":"Injection, dexamethasone sodium phosphate, 1 mg","system":"https://www.cms.gov/mcd/hcpcs"})
+# Vaccines & admins often have G-codes or specific CPTs; this is just a demo subset
+
+HCPCS_MAP = MappingProxyType({
+    "albuterol neb":     HCPCS_ALBUTEROL_NEB,
+    "ceftriaxone inj":   HCPCS_CEFTRIAXONE_INJ,
+    "dexamethasone inj": HCPCS_DEXAMETHASONE_INJ,
+})
+
+PERFORMED_HINTS = frozenset([
     "performed", "done", "completed", "administered", "given", "provided", "carried out",
     "obtained", "obtained in clinic", "obtained today"
-]
+])
+
+# Secondary symptom codes, in the order (and with the rank) they are reported.
+# Keyed by RULE_TERMS category; entries are copied when appended to a result.
+_R06_2  = MappingProxyType({"code":"R06.2","display":"Wheezing","system":"http://hl7.org/fhir/sid/icd-10-cm","rank":2,"confidence":0.62,"rationale":"Documented wheezing."})
+_R06_02 = MappingProxyType({"code":"R06.02","display":"Shortness of breath","system":"http://hl7.org/fhir/sid/icd-10-cm","rank":3,"confidence":0.60,"rationale":"Documented SOB."})
+_R50_9  = MappingProxyType({"code":"R50.9","display":"Fever, unspecified","system":"http://hl7.org/fhir/sid/icd-10-cm","rank":4,"confidence":0.58,"rationale":"Documented fever."})
+_R05_9  = MappingProxyType({"code":"R05.9","display":"Cough, unspecified","system":"http://hl7.org/fhir/sid/icd-10-cm","rank":5,"confidence":0.56,"rationale":"Documented cough."})
+
+SYMPTOM_RULES = (
+    ("wheez", _R06_2),
+    ("sob",   _R06_02),
+    ("fever", _R50_9),
+    ("cough", _R05_9),
+)
 
 # ---------------------------
 # Rule engine (demo)
 # ---------------------------
-def present(text: str, *terms) -> bool:
-    low = text.lower()
-    return all(t in low for t in terms)
+# Every term the rules look at, keyed by category. All of them go into one
+# Aho-Corasick automaton built at import, so a note is scanned exactly once and
+# overlapping terms ("injection given" and "given") are all reported.
+RULE_TERMS = {
+    "cough": ("cough",),
+    "wheez": ("wheez",),
+    "sob": ("shortness of breath",),
+    "fever": ("fever",),
+    "azithro": ("azithromycin",),
+    "xray_dash": ("x-ray",),
+    "xray": ("xray",),
+    "cxr": ("cxr",),
+    "views": ("two views", "2 views", "pa and lateral"),
+    "neb": ("nebulizer", "neb"),
+    "inj": ("intramuscular", "im injection", "injection given", "shot given"),
+    "albuterol": ("albuterol",),
+    "ceftriaxone": ("ceftriaxone",),
+    "dexamethasone": ("dexamethasone",),
+    "perf": tuple(PERFORMED_HINTS),
+}
+
+@st.cache_resource(show_spinner=False)
+def _build_automaton(rule_terms: dict):
+    """Built once per process (Streamlit re-executes this script on every rerun)."""
+    automaton = ahocorasick.Automaton()
+    for cat, terms in rule_terms.items():
+        for term in terms:
+            automaton.add_word(term, (cat, len(term)))
+    automaton.make_automaton()
+    return automaton
 
-def near(text: str, a: str, b: str, window: int = 30) -> bool:
+_AUTOMATON = _build_automaton(RULE_TERMS)
+
+def scan_terms(low: str) -> dict:
+    """
+    One automaton pass over an already lower-cased note. Returns
+    {category: (ends, starts)} with end positions (exclusive) in ascending
+    order and matching start positions.
+    """
+    hits = {}
+    for last, (cat, n) in _AUTOMATON.iter(low):
+        ends, starts = hits.setdefault(cat, ([], []))
+        ends.append(last + 1)
+        starts.append(last + 1 - n)
+    return hits
+
+def near(hits: dict, a: str, b: str, window: int = 30) -> bool:
     """Return True if term b appears within +/-window chars of term a (rough heuristic)."""
-    low = text.lower()
-    a_idx = low.find(a.lower())
-    if a_idx == -1:
+    if a not in hits:
         return False
-    start = max(0, a_idx - window)
-    end   = min(len(low), a_idx + len(a) + window)
-    return b.lower() in low[start:end]
-
-def detect_performed_cxr(note: str):
+    a_ends, a_starts = hits[a]
+    start, end = a_starts[0] - window, a_ends[0] + window
+    b_ends, b_starts = hits.get(b, ((), ()))
+    # candidates end inside [start, end]; they also have to start inside it
+    lo, hi = bisect_left(b_ends, start), bisect_right(b_ends, end)
+    return any(b_starts[i] >= start for i in range(lo, hi))
+
+def detect_performed_cxr(hits: dict):
     """Detect CHEST X-RAY performed; decide CPT (single vs two views) based on language."""
-    low = note.lower()
     # only if presence of performed hints near 'x-ray'
-    if "x-ray" in low or "xray" in low or "cxr" in low:
-        if any(near(low, "x-ray", h, 40) or near(low, "xray", h, 40) or near(low, "cxr", h, 40) for h in PERFORMED_HINTS):
+    if "xray_dash" in hits or "xray" in hits or "cxr" in hits:
+        if near(hits, "xray_dash", "perf", 40) or near(hits, "xray", "perf", 40) or near(hits, "cxr", "perf", 40):
             # crude rules for views
-            if "two views" in low or "2 views" in low or "pa and lateral" in low:
-                return CPT_MAP["chest x-ray two views"]
-            return CPT_MAP["chest x-ray single view"]
+            if "views" in hits:
+                return CPT_CXR_2V
+            return CPT_CXR_1V
     return None
 
-def detect_nebulizer_and_drug(note: str):
+def detect_nebulizer_and_drug(hits: dict, performed_any: bool):
     """Detect a nebulizer treatment performed + the albuterol supply (HCPCS)."""
-    low = note.lower()
-    performed = any(h in low for h in PERFORMED_HINTS)
-    if ("nebulizer" in low or "neb" in low) and performed:
-        cpt = CPT_MAP["nebulizer treatment"]
+    if "neb" in hits and performed_any:
+        cpt = CPT_NEB
         # detect albuterol content
-        if "albuterol" in low:
-            hcpcs = HCPCS_MAP["albuterol neb"]
+        if "albuterol" in hits:
+            hcpcs = HCPCS_ALBUTEROL_NEB
         else:
             hcpcs = None
         return cpt, hcpcs
     return None, None
 
-def detect_injection_and_drug(note: str):
+def detect_injection_and_drug(hits: dict, performed_any: bool):
     """Detect IM/SC injection performed + example HCPCS for common drugs."""
-    low = note.lower()
-    if ("intramuscular" in low or "im injection" in low or "injection given" in low or "shot given" in low) and any(h in low for h in PERFORMED_HINTS):
-        cpt = CPT_MAP["therapeutic injection"]
+    if "inj" in hits and performed_any:
+        cpt = CPT_INJ
         # crude drug matches
-        if "ceftriaxone" in low:
-            return cpt, HCPCS_MAP["ceftriaxone inj"]
-        if "dexamethasone" in low:
-            return cpt, HCPCS_MAP["dexamethasone inj"]
+        if "ceftriaxone" in hits:
+            return cpt, HCPCS_CEFTRIAXONE_INJ
+        if "dexamethasone" in hits:
+            return cpt, HCPCS_DEXAMETHASONE_INJ
         return cpt, None
     return None, None
 
+@st.cache_data(show_spinner=False)
 def tiny_rules(envelope: dict):
     """
     Returns:
@@ -106,14 +176,16 @@ def tiny_rules(envelope: dict):
       hcpcs (list[dict])
     """
     note = (envelope.get("clinical_note") or {}).get("text_preview", "")
-    low  = note.lower()
+    low  = note.lower()  # the only case fold; everything below works on `low`
+    hits = scan_terms(low)
+    performed_any = "perf" in hits  # any PERFORMED_HINTS anywhere in the note
 
     icd10 = []
     procedures = []
     hcpcs = []
 
     # Primary Dx: acute bronchitis pattern
-    if present(low, "cough") and (present(low, "wheez") or present(low, "shortness of breath")) and (present(low, "fever") or present(low, "azithromycin")):
+    if "cough" in hits and ("wheez" in hits or "sob" in hits) and ("fever" in hits or "azithro" in hits):
         icd10.append({
             "code": "J20.9",
             "display": "Acute bronchitis, unspecified organism",
@@ -124,14 +196,9 @@ def tiny_rules(envelope: dict):
         })
 
     # Secondary symptoms
-    if "wheez" in low:
-        icd10.append({"code":"R06.2","display":"Wheezing","system":"http://hl7.org/fhir/sid/icd-10-cm","rank":2,"confidence":0.62,"rationale":"Documented wheezing."})
-    if "shortness of breath" in low:
-        icd10.append({"code":"R06.02","display":"Shortness of breath","system":"http://hl7.org/fhir/sid/icd-10-cm","rank":3,"confidence":0.60,"rationale":"Documented SOB."})
-    if "fever" in low:
-        icd10.append({"code":"R50.9","display":"Fever, unspecified","system":"http://hl7.org/fhir/sid/icd-10-cm","rank":4,"confidence":0.58,"rationale":"Documented fever."})
-    if "cough" in low:
-        icd10.append({"code":"R05.9","display":"Cough, unspecified","system":"http://hl7.org/fhir/sid/icd-10-cm","rank":5,"confidence":0.56,"rationale":"Documented cough."})
+    for term, tmpl in SYMPTOM_RULES:
+        if term in hits:
+            icd10.append(dict(tmpl))
 
     # CPT E/M (MVP default)
     cpt_em = {
@@ -145,23 +212,23 @@ def tiny_rules(envelope: dict):
 
     # --- Performed procedure detection ---
     # 1) Chest X-ray actually performed?
-    cxr = detect_performed_cxr(note)
+    cxr = detect_performed_cxr(hits)
     if cxr:
-        procedures.append(cxr)
+        procedures.append(dict(cxr))
 
     # 2) Nebulizer treatment performed (+ possible albuterol supply)
-    neb_cpt, albut_hcpcs = detect_nebulizer_and_drug(note)
+    neb_cpt, albut_hcpcs = detect_nebulizer_and_drug(hits, performed_any)
     if neb_cpt:
-        procedures.append(neb_cpt)
+        procedures.append(dict(neb_cpt))
     if albut_hcpcs:
-        hcpcs.append(albut_hcpcs)
+        hcpcs.append(dict(albut_hcpcs))
 
     # 3) Therapeutic injection performed (+ possible ceftriaxone/dexamethasone supply)
-    inj_cpt, drug_hcpcs = detect_injection_and_drug(note)
+    inj_cpt, drug_hcpcs = detect_injection_and_drug(hits, performed_any)
     if inj_cpt:
-        procedures.append(inj_cpt)
+        procedures.append(dict(inj_cpt))
     if drug_hcpcs:
-        hcpcs.append(drug_hcpcs)
+        hcpcs.append(dict(drug_hcpcs))
 
     # Guardrail: if only "recommend" test without performed hints, do not add
     # (The detector above already requires PERFORMED_HINTS near target words.)
@@ -173,10 +240,31 @@ def tiny_rules(envelope: dict):
 # ---------------------------
 # FHIR Builders
 # ---------------------------
+# intake sex code -> FHIR administrative gender (anything else is "unknown")
+_SEX_MAP = {"M":"male", "F":"female", "m":"male", "f":"female"}
+
 def fhir_ref(resource_type: str, rid: str) -> dict:
     return {"reference": f"{resource_type}/{rid}"}
 
-def build_fhir_bundle(envelope: dict, icd10: list, cpt_em: dict, procedures: list, hcpcs: list) -> dict:
+def _ids(n: int, rng: random.Random = None) -> list:
+    """n short random hex ids (8 chars each) from a single os.urandom (or rng) call."""
+    b = rng.randbytes(4 * n) if rng else os.urandom(4 * n)
+    return [b[i*4:i*4+4].hex() for i in range(n)]
+
+def _coding(c, default_system: str) -> list:
+    """CodeableConcept.coding[] for one code entry (CPT/HCPCS/...)."""
+    return [{"system": c.get("system", default_system), "code": c["code"], "display": c.get("display","")}]
+
+def _claim_item(seq: int, coding: list, enc_ref: dict, serviced_date) -> dict:
+    """One Claim.item[] entry billing the (single-code) coding list."""
+    return {
+        "sequence": seq,
+        "productOrService": {"coding": coding, "text": coding[0]["display"]},
+        "servicedDate": serviced_date,
+        "encounter": [enc_ref]
+    }
+
+def build_fhir_bundle(envelope: dict, icd10: list, cpt_em: dict, procedures: list, hcpcs: list, rng: random.Random = None) -> dict:
     """
     Bundle (type: collection):
       - Patient
@@ -184,9 +272,14 @@ def build_fhir_bundle(envelope: dict, icd10: list, cpt_em: dict, procedures: lis
       - Claim (diagnosis[], procedure[], item[] for CPT + HCPCS, supportingInfo)
       - Condition (for each ICD-10)
     """
-    pat_id = f"pat-{uuid.uuid4().hex[:8]}"
-    enc_id = f"enc-{uuid.uuid4().hex[:8]}"
-    clm_id = f"clm-{uuid.uuid4().hex[:8]}"
+    now_iso = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())  # Claim.created == Bundle.timestamp
+    ids = _ids(4 + len(icd10), rng)  # patient, encounter, claim, bundle, then one per condition
+    pat_id = f"pat-{ids[0]}"
+    enc_id = f"enc-{ids[1]}"
+    clm_id = f"clm-{ids[2]}"
+    # shared by every resource/item that points back at them; never mutated
+    pat_ref = fhir_ref("Patient", pat_id)
+    enc_ref = fhir_ref("Encounter", enc_id)
 
     patient = envelope.get("patient", {})
     encounter = envelope.get("encounter", {})
@@ -197,7 +290,7 @@ def build_fhir_bundle(envelope: dict, icd10: list, cpt_em: dict, procedures: lis
         "id": pat_id,
         "identifier": [{"system":"urn:mrn","value": patient.get("mrn","")}],
         "name": [{"family": patient.get("last_name",""), "given": [patient.get("first_name","")]}],
-        "gender": {"M":"male","F":"female"}.get(patient.get("sex","").upper(), "unknown"),
+        "gender": _SEX_MAP.get(patient.get("sex",""), "unknown"),
         "birthDate": patient.get("dob","")
     }
 
@@ -206,7 +299,7 @@ def build_fhir_bundle(envelope: dict, icd10: list, cpt_em: dict, procedures: lis
         "id": enc_id,
         "status": "finished",
         "class": {"system":"http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "AMB", "display": "ambulatory"},
-        "subject": fhir_ref("Patient", pat_id),
+        "subject": pat_ref,
         "period": {"start": encounter.get("date"), "end": encounter.get("date")},
         "serviceProvider": {"identifier": {"system":"urn:npi:location", "value": encounter.get("location_npi","")}}
     }
@@ -215,20 +308,14 @@ def build_fhir_bundle(envelope: dict, icd10: list, cpt_em: dict, procedures: lis
     condition_entries = []
     claim_diagnosis = []
     for idx, d in enumerate(icd10, start=1):
-        cond_id = f"cond-{uuid.uuid4().hex[:8]}"
+        cond_id = f"cond-{ids[3 + idx]}"
+        coding = _coding(d, "http://hl7.org/fhir/sid/icd-10-cm")
         condition = {
             "resourceType": "Condition",
             "id": cond_id,
-            "subject": fhir_ref("Patient", pat_id),
-            "encounter": fhir_ref("Encounter", enc_id),
-            "code": {
-                "coding": [{
-                    "system": d.get("system","http://hl7.org/fhir/sid/icd-10-cm"),
-                    "code": d["code"],
-                    "display": d.get("display","")
-                }],
-                "text": d.get("display","")
-            },
+            "subject": pat_ref,
+            "encounter": enc_ref,
+            "code": {"coding": coding, "text": coding[0]["display"]},
             "verificationStatus": {"coding":[{"system":"http://terminology.hl7.org/CodeSystem/condition-ver-status","code":"confirmed"}]},
             "clinicalStatus": {"coding":[{"system":"http://terminology.hl7.org/CodeSystem/condition-clinical","code":"active"}]},
             "note": [{"text": f"rank={d.get('rank')}, confidence={d.get('confidence')}, rationale={d.get('rationale','')}"}]
@@ -246,8 +333,8 @@ def build_fhir_bundle(envelope: dict, icd10: list, cpt_em: dict, procedures: lis
         "status": "active",
         "type": {"coding":[{"system":"http://terminology.hl7.org/CodeSystem/claim-type","code":"professional"}]},
         "use": "claim",
-        "patient": fhir_ref("Patient", pat_id),
-        "created": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "patient": pat_ref,
+        "created": now_iso,
         "enterer": {"identifier": {"system":"urn:npi:provider","value": encounter.get("provider_npi","")}},
         "insurer": {"display": patient.get("payer_name","")},
         "priority": {"coding":[{"system":"http://terminology.hl7.org/CodeSystem/processpriority","code":"normal"}]},
@@ -266,75 +353,39 @@ def build_fhir_bundle(envelope: dict, icd10: list, cpt_em: dict, procedures: lis
         ]
     }
 
-    # Add E/M item
+    # Claim.item[]: E/M first, then performed procedures (CPT), then HCPCS supplies/drugs
+    services = []
     if cpt_em and cpt_em.get("code"):
-        claim["item"].append({
-            "sequence": len(claim["item"]) + 1,
-            "productOrService": {
-                "coding": [{
-                    "system": cpt_em.get("system", "http://www.ama-assn.org/go/cpt"),
-                    "code": cpt_em["code"],
-                    "display": cpt_em.get("display","")
-                }],
-                "text": cpt_em.get("display","")
-            },
-            "servicedDate": encounter.get("date"),
-            "encounter": [fhir_ref("Encounter", enc_id)]
-        })
+        services.append(_coding(cpt_em, "http://www.ama-assn.org/go/cpt"))
         claim["supportingInfo"].append({
-            "sequence": len(claim["supportingInfo"]) + 1,
+            "sequence": 1,
             "category": {"coding":[{"system":"http://terminology.hl7.org/CodeSystem/claiminformationcategory","code":"info"}]},
             "valueString": f"E/M assumes patient status={cpt_em.get('assumed_patient_status','unknown')} (confidence={cpt_em.get('confidence')})"
         })
-
-    # Add performed procedures (CPT) into both Claim.procedure[] and Claim.item[]
-    for i, p in enumerate(procedures, start=1):
-        claim["procedure"].append({
+    # a procedure's coding list is shared by its Claim.procedure[] and Claim.item[] entries
+    proc_codings = [_coding(p, "http://www.ama-assn.org/go/cpt") for p in procedures]
+    services += proc_codings
+    services += [_coding(h, "https://www.cms.gov/mcd/hcpcs") for h in hcpcs]
+    claim["item"] = [
+        _claim_item(seq, coding, enc_ref, encounter.get("date"))
+        for seq, coding in enumerate(services, start=1)
+    ]
+
+    # Performed procedures (CPT) also go into Claim.procedure[]
+    claim["procedure"] = [
+        {
             "sequence": i,
             "date": encounter.get("date"),
-            "procedureCodeableConcept": {
-                "coding": [{
-                    "system": p.get("system","http://www.ama-assn.org/go/cpt"),
-                    "code": p["code"],
-                    "display": p.get("display","")
-                }]
-            }
-        })
-        claim["item"].append({
-            "sequence": len(claim["item"]) + 1,
-            "productOrService": {
-                "coding": [{
-                    "system": p.get("system","http://www.ama-assn.org/go/cpt"),
-                    "code": p["code"],
-                    "display": p.get("display","")
-                }],
-                "text": p.get("display","")
-            },
-            "servicedDate": encounter.get("date"),
-            "encounter": [fhir_ref("Encounter", enc_id)]
-        })
-
-    # Add HCPCS supplies/drugs as separate items
-    for h in hcpcs:
-        claim["item"].append({
-            "sequence": len(claim["item"]) + 1,
-            "productOrService": {
-                "coding": [{
-                    "system": h.get("system","https://www.cms.gov/mcd/hcpcs"),
-                    "code": h["code"],
-                    "display": h.get("display","")
-                }],
-                "text": h.get("display","")
-            },
-            "servicedDate": encounter.get("date"),
-            "encounter": [fhir_ref("Encounter", enc_id)]
-        })
+            "procedureCodeableConcept": {"coding": coding}
+        }
+        for i, coding in enumerate(proc_codings, start=1)
+    ]
 
     bundle = {
         "resourceType": "Bundle",
         "type": "collection",
-        "id": f"bundle-{uuid.uuid4().hex[:8]}",
-        "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "id": f"bundle-{ids[3]}",
+        "timestamp": now_iso,
         "entry": [
             {"resource": fhir_patient},
             {"resource": fhir_encounter},
@@ -344,6 +395,29 @@ def build_fhir_bundle(envelope: dict, icd10: list, cpt_em: dict, procedures: lis
     }
     return bundle
 
+# ---------------------------
+# Pipeline (cached across reruns)
+# ---------------------------
+@st.cache_data(show_spinner=False)
+def _run(envelope_json: str):
+    """
+    Rules + FHIR for one envelope, keyed on its canonical JSON so repeat runs on
+    the same intake come straight from the cache. Ids are drawn from an RNG
+    seeded with that key, so an envelope always maps to the same bundle ids.
+    """
+    envelope = orjson.loads(envelope_json)
+    icd10, cpt_em, procedures, hcpcs = tiny_rules(envelope)
+    bundle = build_fhir_bundle(envelope, icd10, cpt_em, procedures, hcpcs, rng=random.Random(envelope_json))
+    return icd10, cpt_em, procedures, hcpcs, bundle
+
+@st.cache_resource(show_spinner=False)
+def _load_sample(path: str):
+    """Parsed sample envelope (None if the file is missing), read once per process."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
 # ---------------------------
 # UI
 # ---------------------------
@@ -355,30 +429,36 @@ use_sample = st.checkbox("Use sample at /mnt/data/claim_envelope.json", value=Tr
 envelope = None
 if uploaded:
     try:
-        envelope = json.load(uploaded)
+        envelope = orjson.loads(uploaded.getvalue())  # UploadedFile is already in memory
     except Exception as e:
         st.error(f"Invalid JSON: {e}")
-elif use_sample and os.path.exists(default_sample_path):
-    with open(default_sample_path, "r") as f:
-        envelope = json.load(f)
+elif use_sample:
+    envelope = _load_sample(default_sample_path)
 
 if envelope:
     st.success("Intake envelope loaded.")
-    with st.expander("Preview Intake JSON"):
+    # st.json ships the whole tree even inside a collapsed expander; only render on request
+    if st.toggle("Preview Intake JSON", value=False):
         st.json(envelope)
 
     st.subheader("2) Generate FHIR Bundle (with CPT + HCPCS when performed)")
+    envelope_key = orjson.dumps(envelope, option=orjson.OPT_SORT_KEYS).decode("utf-8")
     if st.button("Run Coding Agent → FHIR"):
-        icd10, cpt_em, procedures, hcpcs = tiny_rules(envelope)
-        bundle = build_fhir_bundle(envelope, icd10, cpt_em, procedures, hcpcs)
+        st.session_state["coded_envelope"] = envelope_key
+    # keep the results up across reruns (e.g. flipping the preview toggle) for the same envelope
+    if st.session_state.get("coded_envelope") == envelope_key:
+        icd10, cpt_em, procedures, hcpcs, bundle = _run(envelope_key)
+
+        # serialize once; the viewer and the download share the same bytes
+        bundle_json = orjson.dumps(bundle, option=orjson.OPT_INDENT_2)
 
         st.success("FHIR Bundle ready.")
-        with st.expander("View FHIR JSON"):
-            st.json(bundle)
+        if st.toggle("Preview FHIR JSON", value=False):
+            st.json(bundle_json.decode("utf-8"))
 
         st.download_button(
             "⬇️ Download FHIR Bundle (JSON)",
-            data=json.dumps(bundle, indent=2).encode("utf-8"),
+            data=bundle_json,
             file_name="gooclaim_coding_fhir_bundle.json",
             mime="application/json"
         )